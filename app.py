@@ -2,9 +2,15 @@ import os
 import time
 import threading
 import logging
-from collections import defaultdict
+from array import array
+from collections import OrderedDict
 
+import orjson
+import requests
 from flask import Flask, jsonify, render_template, request
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
+from requests.adapters import HTTPAdapter
 from trino.dbapi import connect
 from trino.exceptions import TrinoExternalError, TrinoUserError, HttpError
 
@@ -19,19 +25,100 @@ MYSQL_SCHEMA = os.getenv("MYSQL_SCHEMA", "crm_1")
 # Cap concurrent Trino calls from this process
 TRINO_MAX_CONCURRENCY = int(os.getenv("TRINO_MAX_CONCURRENCY", "2"))
 
+# Result page size requested from the coordinator when polling a query
+TRINO_TARGET_RESULT_SIZE = os.getenv("TRINO_TARGET_RESULT_SIZE", "16MB")
+
+# Spooled-protocol result encodings, in preference order. trino>=0.333
+# already requests spooling with this same default list; the env var only
+# overrides it, and an empty value disables spooling (classic inline
+# paging). Coordinators without spooling fall back to inline data.
+TRINO_ENCODING = [
+    e.strip() for e in os.getenv("TRINO_ENCODING", "json+zstd,json+lz4,json").split(",") if e.strip()
+] or None
+
 # Cache TTLs (seconds)
 DASHBOARD_CACHE_TTL = int(os.getenv("DASHBOARD_CACHE_TTL", "60"))
 SMALL_CACHE_TTL = int(os.getenv("SMALL_CACHE_TTL", "60"))
+HEALTH_CACHE_TTL = int(os.getenv("HEALTH_CACHE_TTL", "5"))
+# Deadline (seconds) for a whole health probe, slot wait + SELECT 1
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "2"))
+
+# Re-run the dashboard queries in the background before their cache expires
+CACHE_REFRESH = os.getenv("CACHE_REFRESH", "1") == "1"
+
+# Max entries kept in the in-process cache (least recently used evicted)
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "128"))
+
+# How long a request waits on another thread computing the same cache key
+CACHE_WAIT_TIMEOUT = int(os.getenv("CACHE_WAIT_TIMEOUT", "30"))
 
 # How many segments to show on bar/pie lists
 SEGMENT_LIMIT = int(os.getenv("SEGMENT_LIMIT", "8"))
 
+# Top-customer limits are rounded up to one of these before querying, so
+# arbitrary ?limit= values share a handful of cache entries. The largest
+# bucket is also the cap: ?limit= above it returns at most that many rows.
+TOP_CUSTOMER_LIMITS = (5, 10, 20, 50, 100, 200)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson for jsonify(). Dates are passed through to Flask's default()
+    # (HTTP-date strings) and keys are sorted per sort_keys, so output
+    # matches DefaultJSONProvider apart from whitespace.
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Compress JSON payloads worth compressing (monthly series, dashboard)
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+Compress(app)
 log = app.logger
 log.setLevel(logging.INFO)
 
 _gate = threading.BoundedSemaphore(value=TRINO_MAX_CONCURRENCY)
-_cache = {}  # key -> {"t": ts, "v": value}
+_cache = OrderedDict()  # key -> {"t": ts, "v": value}, LRU order
+_cache_lock = threading.RLock()
+_inflight = {}  # key -> {"done": Event, "v": value, "error": exc} while being computed
+_refreshing = threading.local()  # set on the background refresher thread
+# Last health probe result; kept out of cache_ttl so probes never wait on
+# each other: while one probe runs, the others get the last known value
+_health = {"t": 0.0, "ok": True, "running": False}
+_health_lock = threading.Lock()
+
+
+class TrinoHttpSession(requests.Session):
+    # Ask for large result pages so a query drains in fewer nextUri GETs
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() == "GET" and "/v1/statement/" in str(url):
+            params = dict(kwargs.get("params") or {})
+            params.setdefault("targetResultSize", TRINO_TARGET_RESULT_SIZE)
+            kwargs["params"] = params
+        return super().request(method, url, *args, **kwargs)
+
+    def close(self):
+        # trino's Connection.close() closes its http_session; this one is
+        # shared for the process lifetime, so keep its pooled sockets open
+        pass
+
+
+# Shared keep-alive session to the coordinator; connect() otherwise builds
+# a fresh requests.Session (and TCP connection) for every query.
+_http = TrinoHttpSession()
+_http.mount("http://", HTTPAdapter(
+    pool_connections=TRINO_MAX_CONCURRENCY,
+    pool_maxsize=TRINO_MAX_CONCURRENCY * 2,
+))
 
 
 # -------------------------------------------------
@@ -46,16 +133,27 @@ def trino_conn():
         http_scheme="http",
         max_attempts=1,
         request_timeout=10.0,
+        http_session=_http,
+        encoding=TRINO_ENCODING,
+        session_properties={"enable_dynamic_filtering": "true"},
     )
 
 
-def run_query(sql: str):
+class TrinoBusy(Exception):
+    """No Trino slot or in-flight result was available in time, or the
+    single-flight leader failed (its error is chained as __cause__)."""
+
+
+def iter_query(sql: str, gate_timeout: float = None):
+    # Stream rows as the client pages them in; the gate is held until the
+    # caller has drained the result. gate_timeout=None waits for a slot.
+    if not _gate.acquire(timeout=gate_timeout):
+        raise TrinoBusy()
     try:
-        with _gate:
-            with trino_conn() as conn:
-                cur = conn.cursor()
-                cur.execute(sql)
-                return cur.fetchall()
+        with trino_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+            yield from iter(cur.fetchone, None)
     except (TrinoUserError, TrinoExternalError, HttpError) as e:
         name = getattr(e, "error_name", e.__class__.__name__)
         log.warning("Trino error: %s", name)
@@ -63,168 +161,442 @@ def run_query(sql: str):
     except Exception as e:
         log.error("General error talking to Trino: %r", e)
         raise
+    finally:
+        _gate.release()
+
+
+def run_query(sql: str, gate_timeout: float = None):
+    return list(iter_query(sql, gate_timeout=gate_timeout))
+
+
+def _cache_get(key: str, ttl: int):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and (time.time() - entry["t"] < ttl):
+            _cache.move_to_end(key)
+            return entry
+        return None
+
+
+def cache_entry(key: str, ttl: int, fn):
+    # Returns (computed_at, value) for the entry that was served
+    if getattr(_refreshing, "on", False):
+        ttl = ttl / 2  # refresher treats half-aged entries as stale
+    entry = _cache_get(key, ttl)
+    if entry:
+        return entry["t"], entry["v"]
+    # Single flight: the first thread on a cold key computes it, the rest
+    # wait for that result (or error) instead of querying Trino themselves
+    with _cache_lock:
+        entry = _cache_get(key, ttl)
+        if entry:
+            return entry["t"], entry["v"]
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = {"done": threading.Event(), "t": None, "v": None, "error": None}
+    if not leader:
+        if not flight["done"].wait(timeout=CACHE_WAIT_TIMEOUT):
+            raise TrinoBusy()
+        if flight["error"] is not None:
+            # A fresh exception per waiter; re-raising the leader's instance
+            # from many threads would keep growing its shared traceback
+            raise TrinoBusy() from flight["error"]
+        return flight["t"], flight["v"]
+    try:
+        now = time.time()
+        v = fn()
+        with _cache_lock:
+            _cache[key] = {"t": now, "v": v}
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_MAXSIZE:
+                _cache.popitem(last=False)
+        flight["t"], flight["v"] = now, v
+        return now, v
+    except Exception as e:
+        flight["error"] = e
+        raise
+    except BaseException:
+        # Leader was killed (GreenletExit, gevent.Timeout, KeyboardInterrupt);
+        # waiters must not see an empty value, nor inherit that signal.
+        flight["error"] = TrinoBusy()
+        raise
+    finally:
+        with _cache_lock:
+            del _inflight[key]
+        flight["done"].set()
 
 
 def cache_ttl(key: str, ttl: int, fn):
-    now = time.time()
-    entry = _cache.get(key)
-    if entry and (now - entry["t"] < ttl):
-        return entry["v"]
-    v = fn()
-    _cache[key] = {"t": now, "v": v}
-    return v
+    return cache_entry(key, ttl, fn)[1]
+
+
+def cached_json(tag: str, computed_at: float, data, ttl: int):
+    # Let the browser/intermediaries reuse a payload for as long as we do,
+    # and answer revalidations with 304 while the cache entry is unchanged.
+    # The weak ETag comes from the timestamp of the entry `data` was read
+    # from (see cache_entry), not from the payload.
+    etag = f"{tag}-{int(computed_at * 1000)}"
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(data)
+    resp.set_etag(etag, weak=True)
+    # Only the entry's remaining lifetime, so downstream caches expire with us
+    max_age = max(0, int(ttl - (time.time() - computed_at)))
+    resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return resp
+
+
+def money(value):
+    # Aggregates come back unrounded; presentation rounding happens here
+    return round(float(value or 0), 2)
+
+
+def monthly_series(rows):
+    # rows: ('YYYY-MM', segment, revenue) ordered by month, segment.
+    # Cells live in one flat float array indexed [seg_idx * M + month_idx];
+    # each segment's row starts zeroed and is sliced out as its dataset.
+    rows = list(rows)
+    months = sorted({m for m, _, _ in rows})
+    month_idx = {m: i for i, m in enumerate(months)}
+    width = len(months)
+    zeros = array("d", [0.0]) * width
+    segments, seg_idx = [], {}
+    cells = array("d")
+    for m, seg, rev in rows:
+        i = seg_idx.get(seg)
+        if i is None:
+            i = seg_idx[seg] = len(segments)
+            segments.append(seg)
+            cells.extend(zeros)
+        cells[i * width + month_idx[m]] = money(rev)
+    datasets = [
+        {"label": seg, "data": cells[i * width:(i + 1) * width].tolist()}
+        for i, seg in enumerate(segments)
+    ]
+    return {"labels": months, "datasets": datasets}
 
 
 # -------------------------------------------------
 # Queries anchored to data's max(orderdate) (not current_date)
 # -------------------------------------------------
+# compute_* return the (computed_at, payload) cache entry they served, so
+# routes can tag responses with the timestamp of the exact payload sent.
+
+# Trailing 12 months relative to the data's latest orderdate
+WINDOW_FILTER = "o.orderdate >= date_add('month', -12, {maxd})"
+
+# Drop non-VIP orders before they reach the pre-aggregation/join; the vip
+# set is small, so Trino builds it once and dynamic-filters the orders scan
+VIP_SEMI_JOIN = f"o.custkey IN (SELECT custkey FROM mysql.{MYSQL_SCHEMA}.vip_customers)"
+
+
+_SQL_MAX_ORDER_DATE = "SELECT CAST(max(orderdate) AS varchar) FROM tpch.tiny.orders"
+
+
+def max_order_date():
+    # Resolved once per cache window so the aggregate queries filter on a
+    # literal instead of re-scanning orders for max(orderdate) each time.
+    return cache_ttl("maxd", SMALL_CACHE_TTL, lambda: run_query(_SQL_MAX_ORDER_DATE)[0][0])
+
+
+def render_sql(template: str, **params):
+    # Templates below are rendered once at import; only the data-dependent
+    # window bound (and top-customer LIMIT) is filled in per call.
+    # With no orders max(orderdate) is NULL; a NULL bound matches no rows,
+    # so the aggregates come back as zeros/empty just like the bounds CTE did.
+    maxd = max_order_date()
+    bound = f"DATE '{maxd}'" if maxd else "CAST(NULL AS date)"
+    return template.format(maxd=bound, **params)
+
+
+# Segment queries pre-aggregate orders per custkey (`pre`) before joining
+# customer/vip_customers, so the join sees one row per customer instead of
+# one per order. AVG is rebuilt as SUM(s) / SUM(n) to stay exact.
+_SQL_KPIS = f"""
+    WITH totals AS (
+        SELECT
+            COALESCE(SUM(o.totalprice), 0)          AS total_revenue,
+            CAST(COUNT(*) AS BIGINT)                AS total_orders,
+            COALESCE(AVG(o.totalprice), 0)          AS avg_order_value
+        FROM tpch.tiny.orders o
+        WHERE {WINDOW_FILTER}
+    ),
+    pre AS (
+        SELECT o.custkey, SUM(o.totalprice) AS s
+        FROM tpch.tiny.orders o
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY o.custkey
+    ),
+    top_seg AS (
+        SELECT v.segment, SUM(p.s) AS rev
+        FROM pre p
+        JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+        JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+        GROUP BY v.segment
+        ORDER BY rev DESC
+        LIMIT 1
+    )
+    SELECT
+      t.total_revenue,
+      t.total_orders,
+      t.avg_order_value,
+      COALESCE(s.segment, '—') AS top_segment
+    FROM totals t
+    LEFT JOIN top_seg s ON true
+    """
+
+
 def compute_kpis():
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders),
-        totals AS (
-            SELECT
-                ROUND(COALESCE(SUM(o.totalprice), 0), 2) AS total_revenue,
-                CAST(COUNT(*) AS BIGINT)                AS total_orders,
-                ROUND(COALESCE(AVG(o.totalprice), 0),2) AS avg_order_value
-            FROM tpch.tiny.orders o
-            CROSS JOIN bounds b
-            WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        ),
-        top_seg AS (
-            SELECT v.segment, SUM(o.totalprice) AS rev
-            FROM tpch.tiny.orders o
-            JOIN tpch.tiny.customer c ON o.custkey = c.custkey
-            JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-            CROSS JOIN bounds b
-            WHERE o.orderdate >= date_add('month', -12, b.maxd)
-            GROUP BY v.segment
-            ORDER BY rev DESC
-            LIMIT 1
-        )
-        SELECT
-          t.total_revenue,
-          t.total_orders,
-          t.avg_order_value,
-          COALESCE(s.segment, '—') AS top_segment
-        FROM totals t
-        LEFT JOIN top_seg s ON true
-        """
-        rows = run_query(sql)
+        rows = run_query(render_sql(_SQL_KPIS))
         row = rows[0] if rows else (0.0, 0, 0.0, "—")
         return {
-            "total_revenue": float(row[0] or 0),
+            "total_revenue": money(row[0]),
             "total_orders": int(row[1] or 0),
-            "avg_order_value": float(row[2] or 0),
+            "avg_order_value": money(row[2]),
             "top_segment": row[3] or "—",
         }
-    return cache_ttl("kpis", SMALL_CACHE_TTL, _do)
+    return cache_entry("kpis", SMALL_CACHE_TTL, _do)
+
+
+_SQL_REVENUE_BY_SEGMENT = f"""
+    WITH pre AS (
+        SELECT o.custkey, SUM(o.totalprice) AS s
+        FROM tpch.tiny.orders o
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY o.custkey
+    )
+    SELECT v.segment, SUM(p.s) AS revenue
+    FROM pre p
+    JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+    JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+    GROUP BY v.segment
+    ORDER BY revenue DESC
+    LIMIT {SEGMENT_LIMIT}
+    """
 
 
 def compute_revenue_by_segment():
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders)
-        SELECT v.segment, ROUND(SUM(o.totalprice), 2) AS revenue
+        labels, values = [], []
+        for seg, value in iter_query(render_sql(_SQL_REVENUE_BY_SEGMENT)):
+            labels.append(seg)
+            values.append(money(value))
+        return {"labels": labels, "values": values}
+    return cache_entry("revenue_by_segment", SMALL_CACHE_TTL, _do)
+
+
+_SQL_AVG_ORDER_VALUE_BY_SEGMENT = f"""
+    WITH pre AS (
+        SELECT o.custkey, SUM(o.totalprice) AS s, COUNT(*) AS n
         FROM tpch.tiny.orders o
-        JOIN tpch.tiny.customer c ON o.custkey = c.custkey
-        JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-        CROSS JOIN bounds b
-        WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        GROUP BY v.segment
-        ORDER BY revenue DESC
-        LIMIT {SEGMENT_LIMIT}
-        """
-        rows = run_query(sql)
-        return {"labels": [r[0] for r in rows], "values": [float(r[1]) for r in rows]}
-    return cache_ttl("revenue_by_segment", SMALL_CACHE_TTL, _do)
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY o.custkey
+    )
+    SELECT v.segment, SUM(p.s) / SUM(p.n) AS avg_order_value
+    FROM pre p
+    JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+    JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+    GROUP BY v.segment
+    ORDER BY avg_order_value DESC
+    LIMIT {SEGMENT_LIMIT}
+    """
 
 
 def compute_avg_order_value_by_segment():
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders)
-        SELECT v.segment, ROUND(AVG(o.totalprice), 2) AS avg_order_value
+        labels, values = [], []
+        for seg, value in iter_query(render_sql(_SQL_AVG_ORDER_VALUE_BY_SEGMENT)):
+            labels.append(seg)
+            values.append(money(value))
+        return {"labels": labels, "values": values}
+    return cache_entry("avg_order_value_by_segment", SMALL_CACHE_TTL, _do)
+
+
+_SQL_ORDERS_COUNT_BY_SEGMENT = f"""
+    WITH pre AS (
+        SELECT o.custkey, COUNT(*) AS n
         FROM tpch.tiny.orders o
-        JOIN tpch.tiny.customer c ON o.custkey = c.custkey
-        JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-        CROSS JOIN bounds b
-        WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        GROUP BY v.segment
-        ORDER BY avg_order_value DESC
-        LIMIT {SEGMENT_LIMIT}
-        """
-        rows = run_query(sql)
-        return {"labels": [r[0] for r in rows], "values": [float(r[1]) for r in rows]}
-    return cache_ttl("avg_order_value_by_segment", SMALL_CACHE_TTL, _do)
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY o.custkey
+    )
+    SELECT v.segment, SUM(p.n) AS orders
+    FROM pre p
+    JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+    JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+    GROUP BY v.segment
+    ORDER BY orders DESC
+    LIMIT {SEGMENT_LIMIT}
+    """
 
 
 def compute_orders_count_by_segment():
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders)
-        SELECT v.segment, COUNT(*) AS orders
+        labels, values = [], []
+        for seg, value in iter_query(render_sql(_SQL_ORDERS_COUNT_BY_SEGMENT)):
+            labels.append(seg)
+            values.append(int(value))
+        return {"labels": labels, "values": values}
+    return cache_entry("orders_count_by_segment", SMALL_CACHE_TTL, _do)
+
+
+_SQL_MONTHLY_REVENUE_BY_SEGMENT = f"""
+    WITH pre AS (
+        SELECT o.custkey, format_datetime(date_trunc('month', o.orderdate), 'yyyy-MM') AS m,
+               SUM(o.totalprice) AS s
         FROM tpch.tiny.orders o
-        JOIN tpch.tiny.customer c ON o.custkey = c.custkey
-        JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-        CROSS JOIN bounds b
-        WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        GROUP BY v.segment
-        ORDER BY orders DESC
-        LIMIT {SEGMENT_LIMIT}
-        """
-        rows = run_query(sql)
-        return {"labels": [r[0] for r in rows], "values": [int(r[1]) for r in rows]}
-    return cache_ttl("orders_count_by_segment", SMALL_CACHE_TTL, _do)
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY 1, 2
+    )
+    SELECT p.m,
+           v.segment,
+           SUM(p.s) AS revenue
+    FROM pre p
+    JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+    JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    """
 
 
 def compute_monthly_revenue_by_segment():
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders)
-        SELECT date_trunc('month', o.orderdate) AS m,
-               v.segment,
-               ROUND(SUM(o.totalprice), 2) AS revenue
+        return monthly_series(iter_query(render_sql(_SQL_MONTHLY_REVENUE_BY_SEGMENT)))
+    return cache_entry("monthly_revenue_by_segment", SMALL_CACHE_TTL, _do)
+
+
+_SQL_TOP_CUSTOMERS = f"""
+    WITH pre AS (
+        SELECT o.custkey, SUM(o.totalprice) AS s, COUNT(*) AS n
         FROM tpch.tiny.orders o
-        JOIN tpch.tiny.customer c ON o.custkey = c.custkey
-        JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-        CROSS JOIN bounds b
-        WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        GROUP BY 1, 2
-        ORDER BY 1, 2
-        """
-        rows = run_query(sql)
-        months = sorted({str(r[0])[:7] for r in rows})  # 'YYYY-MM'
-        by_seg = defaultdict(lambda: {m: 0.0 for m in months})
-        for m, seg, rev in rows:
-            key = str(m)[:7]
-            by_seg[seg][key] = float(rev)
-        datasets = [{"label": seg, "data": [by_seg[seg][m] for m in months]} for seg in by_seg.keys()]
-        return {"labels": months, "datasets": datasets}
-    return cache_ttl("monthly_revenue_by_segment", SMALL_CACHE_TTL, _do)
+        WHERE {WINDOW_FILTER}
+          AND {VIP_SEMI_JOIN}
+        GROUP BY o.custkey
+    )
+    SELECT c.name AS customer_name,
+           v.segment,
+           SUM(p.n) AS orders,
+           SUM(p.s) AS revenue
+    FROM pre p
+    JOIN tpch.tiny.customer c ON p.custkey = c.custkey
+    JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
+    GROUP BY c.name, v.segment
+    ORDER BY revenue DESC
+    LIMIT {{limit}}
+    """
 
 
 def compute_top_customers(limit: int):
     key = f"top_customers_{limit}"
     def _do():
-        sql = f"""
-        WITH bounds AS (SELECT max(orderdate) AS maxd FROM tpch.tiny.orders)
-        SELECT c.name AS customer_name,
-               v.segment,
-               COUNT(o.orderkey)            AS orders,
-               ROUND(SUM(o.totalprice), 2)  AS revenue
-        FROM tpch.tiny.customer c
-        JOIN tpch.tiny.orders   o ON o.custkey = c.custkey
+        return [
+            {"customer_name": name, "segment": seg, "orders": int(orders), "revenue": money(revenue)}
+            for name, seg, orders, revenue in iter_query(render_sql(_SQL_TOP_CUSTOMERS, limit=limit))
+        ]
+    return cache_entry(key, SMALL_CACHE_TTL, _do)
+
+
+_SQL_DASHBOARD = f"""
+    WITH pre AS (
+        SELECT o.custkey, format_datetime(date_trunc('month', o.orderdate), 'yyyy-MM') AS m,
+               SUM(o.totalprice) AS s, COUNT(*) AS n
+        FROM tpch.tiny.orders o
+        WHERE {WINDOW_FILTER}
+        GROUP BY 1, 2
+    ),
+    base AS (
+        SELECT p.m, p.s, p.n, v.segment
+        FROM pre p
+        JOIN tpch.tiny.customer c ON p.custkey = c.custkey
         JOIN mysql.{MYSQL_SCHEMA}.vip_customers v ON v.custkey = c.custkey
-        CROSS JOIN bounds b
-        WHERE o.orderdate >= date_add('month', -12, b.maxd)
-        GROUP BY c.name, v.segment
-        ORDER BY revenue DESC
-        LIMIT {limit}
-        """
-        rows = run_query(sql)
-        return [{"customer_name": r[0], "segment": r[1], "orders": int(r[2]), "revenue": float(r[3])} for r in rows]
-    return cache_ttl(key, SMALL_CACHE_TTL, _do)
+    )
+    SELECT 'totals'                                        AS kind,
+           CAST(NULL AS varchar)                           AS k1,
+           CAST(NULL AS varchar)                           AS k2,
+           COALESCE(SUM(s), 0)                             AS revenue,
+           CAST(COALESCE(SUM(n), 0) AS BIGINT)             AS orders,
+           COALESCE(SUM(s) / NULLIF(SUM(n), 0), 0)         AS avg_order_value
+    FROM pre
+    UNION ALL
+    SELECT 'segment', segment, NULL,
+           SUM(s), SUM(n), SUM(s) / SUM(n)
+    FROM base
+    GROUP BY segment
+    UNION ALL
+    SELECT 'monthly', m, segment,
+           SUM(s), SUM(n), CAST(NULL AS double)
+    FROM base
+    GROUP BY m, segment
+    """
+
+
+def compute_dashboard():
+    # One statement for the whole dashboard: orders are scanned and rolled up
+    # per (custkey, month) once in `pre`. Totals read `pre` directly (all
+    # orders, like /api/kpis); segment and monthly rows read the VIP join in
+    # `base`. Each aggregate comes back as rows tagged by `kind`.
+    def _do():
+        totals = (0.0, 0, 0.0)
+        segments, monthly = [], []
+        for kind, k1, k2, revenue, orders, aov in iter_query(render_sql(_SQL_DASHBOARD)):
+            if kind == "totals":
+                totals = (revenue, orders, aov)
+            elif kind == "segment":
+                segments.append((k1, revenue, orders, aov))
+            else:
+                monthly.append((k1, k2, revenue))
+
+        def _top(idx, cast):
+            ranked = sorted(segments, key=lambda r: r[idx], reverse=True)[:SEGMENT_LIMIT]
+            return {"labels": [r[0] for r in ranked], "values": [cast(r[idx]) for r in ranked]}
+
+        revenue_by_segment = _top(1, money)
+        return {
+            "kpis": {
+                "total_revenue": money(totals[0]),
+                "total_orders": int(totals[1] or 0),
+                "avg_order_value": money(totals[2]),
+                "top_segment": (revenue_by_segment["labels"] or [None])[0] or "—",
+            },
+            "revenue_by_segment": revenue_by_segment,
+            "avg_order_value_by_segment": _top(3, money),
+            "orders_count_by_segment": _top(2, int),
+            # ORDER BY month, segment with NULL segments last, as Trino sorts
+            "monthly_revenue_by_segment": monthly_series(
+                sorted(monthly, key=lambda r: (r[0], r[1] is None, r[1] or ""))
+            ),
+        }
+    return cache_entry("dashboard", DASHBOARD_CACHE_TTL, _do)
+
+
+# -------------------------------------------------
+# Background refresh (stale-while-revalidate)
+# -------------------------------------------------
+def _refresher():
+    _refreshing.on = True
+    interval = max(min(DASHBOARD_CACHE_TTL, SMALL_CACHE_TTL) / 2, 1)
+    jobs = [compute_dashboard, lambda: compute_top_customers(TOP_CUSTOMER_LIMITS[0])]
+    while True:
+        # Leave Trino to user traffic when every slot is taken
+        if _gate.acquire(blocking=False):
+            _gate.release()
+            for fn in jobs:
+                try:
+                    fn()
+                except Exception as e:
+                    log.warning("cache refresh error: %r", e)
+        time.sleep(interval)
+
+
+if CACHE_REFRESH:
+    threading.Thread(target=_refresher, name="cache-refresher", daemon=True).start()
 
 
 # -------------------------------------------------
@@ -235,19 +607,46 @@ def index():
     return render_template("index.html")
 
 
+def _health_probe():
+    ok = False
+    try:
+        run_query("SELECT 1", gate_timeout=0.2)
+        ok = True
+    except TrinoBusy:
+        ok = True  # every slot is serving real queries
+    except Exception:
+        pass
+    finally:
+        with _health_lock:
+            _health.update(t=time.time(), ok=ok, running=False)
+
+
 @app.get("/api/health")
 def health():
-    try:
-        run_query("SELECT 1")
+    with _health_lock:
+        probe = not _health["running"] and time.time() - _health["t"] >= HEALTH_CACHE_TTL
+        if probe:
+            _health["running"] = True
+    if probe:
+        # The probe runs on its own thread so a slow SELECT 1 cannot hold
+        # this request past the deadline; its late result still lands.
+        t = threading.Thread(target=_health_probe, name="health-probe", daemon=True)
+        t.start()
+        t.join(HEALTH_PROBE_TIMEOUT)
+        with _health_lock:
+            if _health["running"]:
+                _health.update(t=time.time(), ok=False)
+    with _health_lock:
+        ok = _health["ok"]
+    if ok:
         return jsonify({"ok": True})
-    except Exception:
-        return jsonify({"ok": False}), 503
+    return jsonify({"ok": False}), 503
 
 
 @app.get("/api/kpis")
 def kpis():
     try:
-        return jsonify(compute_kpis())
+        return cached_json("kpis", *compute_kpis(), SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("kpis error: %r", e)
         return jsonify({}), 200
@@ -256,7 +655,7 @@ def kpis():
 @app.get("/api/revenue_by_segment")
 def revenue_by_segment():
     try:
-        return jsonify(compute_revenue_by_segment())
+        return cached_json("revenue_by_segment", *compute_revenue_by_segment(), SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("revenue_by_segment error: %r", e)
         return jsonify({"labels": [], "values": []}), 200
@@ -264,13 +663,17 @@ def revenue_by_segment():
 
 @app.get("/api/revenue_share_by_segment")
 def revenue_share_by_segment():
-    return revenue_by_segment()
+    try:
+        return cached_json("revenue_by_segment", *compute_revenue_by_segment(), SMALL_CACHE_TTL)
+    except Exception as e:
+        log.warning("revenue_share_by_segment error: %r", e)
+        return jsonify({"labels": [], "values": []}), 200
 
 
 @app.get("/api/avg_order_value_by_segment")
 def avg_order_value_by_segment():
     try:
-        return jsonify(compute_avg_order_value_by_segment())
+        return cached_json("avg_order_value_by_segment", *compute_avg_order_value_by_segment(), SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("avg_order_value_by_segment error: %r", e)
         return jsonify({"labels": [], "values": []}), 200
@@ -279,7 +682,7 @@ def avg_order_value_by_segment():
 @app.get("/api/orders_count_by_segment")
 def orders_count_by_segment():
     try:
-        return jsonify(compute_orders_count_by_segment())
+        return cached_json("orders_count_by_segment", *compute_orders_count_by_segment(), SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("orders_count_by_segment error: %r", e)
         return jsonify({"labels": [], "values": []}), 200
@@ -288,7 +691,7 @@ def orders_count_by_segment():
 @app.get("/api/monthly_revenue_by_segment")
 def monthly_revenue_by_segment():
     try:
-        return jsonify(compute_monthly_revenue_by_segment())
+        return cached_json("monthly_revenue_by_segment", *compute_monthly_revenue_by_segment(), SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("monthly_revenue_by_segment error: %r", e)
         return jsonify({"labels": [], "datasets": []}), 200
@@ -296,10 +699,13 @@ def monthly_revenue_by_segment():
 
 @app.get("/api/top_customers")
 def top_customers():
-    limit = int(request.args.get("limit", 20))
+    limit = request.args.get("limit", 20, type=int)
+    if limit < 1:
+        return jsonify({"rows": []})
+    bucket = next((n for n in TOP_CUSTOMER_LIMITS if n >= limit), TOP_CUSTOMER_LIMITS[-1])
     try:
-        rows = compute_top_customers(limit)
-        return jsonify({"rows": rows})
+        computed_at, rows = compute_top_customers(bucket)
+        return cached_json(f"top_customers_{bucket}-{limit}", computed_at, {"rows": rows[:limit]}, SMALL_CACHE_TTL)
     except Exception as e:
         log.warning("top_customers error: %r", e)
         return jsonify({"rows": []}), 200
@@ -308,14 +714,7 @@ def top_customers():
 @app.get("/api/dashboard")
 def dashboard():
     try:
-        data = cache_ttl("dashboard", DASHBOARD_CACHE_TTL, lambda: {
-            "kpis": compute_kpis(),
-            "revenue_by_segment": compute_revenue_by_segment(),
-            "avg_order_value_by_segment": compute_avg_order_value_by_segment(),
-            "orders_count_by_segment": compute_orders_count_by_segment(),
-            "monthly_revenue_by_segment": compute_monthly_revenue_by_segment(),
-        })
-        return jsonify(data)
+        return cached_json("dashboard", *compute_dashboard(), DASHBOARD_CACHE_TTL)
     except Exception as e:
         log.warning("dashboard aggregation error: %r", e)
         return jsonify({"error": "trino_busy"}), 200
@@ -109,6 +109,9 @@ async function loadTopCustomers(limit = 5) {
 }
 
 async function initDashboard() {
+  // Initial top customers (default 5); independent of the dashboard call,
+  // so both requests are in flight at once
+  const topCustomers = loadTopCustomers(5).catch(e => console.error(e));
   try {
     // Single call to get KPIs + small charts
     const dash = await fetchJSON("/api/dashboard");
@@ -127,11 +130,10 @@ async function initDashboard() {
     if (dash.avg_order_value_by_segment) renderBarAOVSegment(dash.avg_order_value_by_segment);
     if (dash.orders_count_by_segment) renderBarOrdersSegment(dash.orders_count_by_segment);
     if (dash.monthly_revenue_by_segment) renderLineMonthly(dash.monthly_revenue_by_segment);
-
-    // Initial top customers (default 5)
-    await loadTopCustomers(5);
   } catch (e) {
     console.error(e);
+  } finally {
+    await topCustomers;
   }
 }
 